@@ -101,6 +101,7 @@ def rebin_1D(double[:] counts, double[:] edges_in, double[:] edges_out):
     cdef int i, j
     cdef double Eout_i, Ein_j
     cdef double bins_overlap
+    cdef double counts_out_i
     for i in range(Nout):
         # Only loop over the relevant subset of j indices where there may be
         # overlap:
@@ -108,12 +109,16 @@ def rebin_1D(double[:] counts, double[:] edges_in, double[:] edges_out):
         jmax = min(Nin-1, int((a0_out + a1_out*(i+1) - a0_in)/a1_in))
         # Calculate the bin edge energies manually for speed:
         Eout_i = a0_out + a1_out*i
+        # Accumulate in a local variable and divide by a1_in once per
+        # output bin, keeping the inner loop to a multiply-add:
+        counts_out_i = 0.0
         for j in range(jmin, jmax+1):
             # Calculate proportionality factor based on current overlap:
             Ein_j = a0_in + a1_in*j
             bins_overlap = overlap(Ein_j, Ein_j+a1_in,
                                    Eout_i, Eout_i+a1_out)
-            counts_out_view[i] += counts[j] * bins_overlap / a1_in
+            counts_out_i += counts[j] * bins_overlap
+        counts_out_view[i] = counts_out_i / a1_in
 
     return counts_out
 
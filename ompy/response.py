@@ -4,8 +4,9 @@
 import os
 import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 # import matplotlib.pyplot as plt
-from scipy.interpolate import interp1d#, interp2d
+from scipy.interpolate import interp1d
 
 # from .firstgen import *
 # from .unfold import *
@@ -25,6 +26,57 @@ DTYPE = np.float64
 # j_test = 50
 
 
+def rebin_weight_matrix(E_array_in, E_array_out):
+    """ Construct the overlap matrix W rebinning from E_array_in to E_array_out
+
+    The matrix W is defined such that W.dot(counts_in) rebins counts_in
+    from calibration E_array_in to E_array_out, preserving the total
+    number of counts. It is the same bin-overlap calculation as in
+    rebin.pyx, but vectorized. Since W only depends on the two
+    calibrations, it can be computed once and applied to any number of
+    spectra.
+
+    The bin edges are monotone, so each input bin only overlaps a small
+    contiguous range of output bins. np.searchsorted locates that range
+    for all input bins at once, and the overlaps are filled in with one
+    vectorized sweep per overlapped output bin -- O(Nin + Nout) work
+    instead of evaluating all Nout*Nin bin pairs.
+
+    Args:
+        E_array_in: Array of lower-bin-edge energies giving the
+                    calibration of the input spectra
+        E_array_out: Array of lower-bin-edge energies giving the
+                     calibration of the output spectra
+    Returns:
+        W: Overlap matrix of shape (len(E_array_out), len(E_array_in))
+    """
+    Nin, Nout = len(E_array_in), len(E_array_out)
+    a1_in = E_array_in[1] - E_array_in[0]
+    a1_out = E_array_out[1] - E_array_out[0]
+    # Upper edge of the last bin has to be added to get N+1 edges:
+    edges_in = np.append(E_array_in, E_array_in[-1] + a1_in)
+    edges_out = np.append(E_array_out, E_array_out[-1] + a1_out)
+
+    # First and one-past-last output bin touched by each input bin:
+    idx_lo = np.searchsorted(edges_out, edges_in[:-1], side="right") - 1
+    idx_hi = np.searchsorted(edges_out, edges_in[1:], side="left")
+
+    W = np.zeros((Nout, Nin))
+    cols = np.arange(Nin)
+    # An input bin overlaps at most ceil(a1_in/a1_out)+1 output bins, so
+    # this loop runs a small, constant number of times. np.add.at
+    # scatter-adds the partial overlaps in C, accumulating correctly
+    # even if a bin pair were to be visited more than once:
+    for k in range(int(np.max(idx_hi - idx_lo))):
+        rows = idx_lo + k
+        valid = (rows < idx_hi) & (rows >= 0) & (rows < Nout)
+        r, c = rows[valid], cols[valid]
+        overlap = (np.minimum(edges_out[r+1], edges_in[c+1])
+                   - np.maximum(edges_out[r], edges_in[c]))
+        np.add.at(W, (r, c), np.maximum(overlap, 0) / a1_in)
+    return W
+
+
 def E_compton(Eg, theta):
     """
     Calculates the energy of an electron that is scattered an angle
@@ -32,14 +84,16 @@ def E_compton(Eg, theta):
     Adapted from MAMA, file "folding.f", which references
     Canberra catalog ed.7, p.2.
     Inputs:
-    Eg: Energy of gamma-ray in keV
-    theta: Angle of scatter in radians
+    Eg: Energy of gamma-ray in keV (scalar)
+    theta: Angle of scatter in radians (scalar or array)
     Returns:
     Energy Ee of scattered electron
     """
     # Return Eg if Eg <= 0.1, else use formula
-    # print("From E_compton(): Eg =", Eg, ", theta =", theta, ", formula =", Eg*Eg/511*(1-np.cos(theta)) / (1+Eg/511 * (1-np.cos(theta))))
-    return np.where(Eg > 0.1, Eg*Eg/511*(1-np.cos(theta)) / (1+Eg/511 * (1-np.cos(theta))), Eg)
+    if Eg <= 0.1:
+        return Eg
+    t = Eg/511 * (1 - np.cos(theta))
+    return Eg*t / (1 + t)
 
 
 def corr(Eg, theta):
@@ -63,6 +117,11 @@ def Emid_to_bin(Emid, a0, a1):
     return int(i)
 
 
+def Emid_to_bin_array(Emid, a0, a1):
+    """ Array version of Emid_to_bin; Emid is an array of mid-bin energies """
+    return ((Emid - a1/2 - a0)/a1).astype(np.int64)
+
+
 def two_channel_split(E_centroid, E_array):
     """
     When E_centroid is between two bins in E_array, this function
@@ -125,7 +184,6 @@ def interpolate_response(folderpath, Eout_array, fwhm_abs, return_table=False):
 
     # Read resp.dat file, which gives information about the energy bins
     # and discrete peaks
-    resp = []
     Nlines = -1
     with open(os.path.join(folderpath, "resp.dat")) as file:
         while True:
@@ -144,14 +202,11 @@ def interpolate_response(folderpath, Eout_array, fwhm_abs, return_table=False):
         if not line:
             raise Exception("Error reading resp.dat")
 
-        for i in range(Nlines):
-            line = file.readline()
-            # print("line =", line)
-            row = np.array(line.split(), dtype="double")
-            resp.append(row)
+        # np.loadtxt picks up at the current cursor position and parses
+        # the whole table in one go:
+        resp = np.loadtxt(file, max_rows=Nlines)
 
     # Unpack the resp matrix into its columns
-    resp = np.array(resp)
     Eg_sim_array, fwhm_rel, Eff_tot, FE, SE, DE, c511 = resp.T
     a0_sim, a1_sim = Eg_sim_array[0], Eg_sim_array[1]-Eg_sim_array[0]
     # print("a0_sim, a1_sim =", a0_sim, a1_sim, flush=True)
@@ -172,39 +227,50 @@ def interpolate_response(folderpath, Eout_array, fwhm_abs, return_table=False):
 
     # Read in Compton spectra for each Eg channel:
     N_Eg = len(Eg_sim_array)
+    # Precompute the spectrum filenames so the reading loop is pure I/O:
+    fnames = [os.path.join(folderpath, "cmp"+str(int(Eg)))
+              for Eg in Eg_sim_array]
     # Read first Compton spectrum to get number of energy channels in each:
     N_cmp = -1
     a0_cmp, a1_cmp = -1, -1
     # Get calibration and array length from highest-energy spectrum, because the spectra
     # may have differing length but this is bound to be the longest.
-    with open(os.path.join(folderpath,"cmp"+str(int(Eg_sim_array[-1])))) as file:
+    with open(fnames[-1]) as file:
         lines = file.readlines()
         a0_cmp = float(lines[6].split(",")[1]) # calibration
         a1_cmp = float(lines[6].split(",")[2]) # coefficients [keV]
         N_cmp = int(lines[8][15:]) +1 # 0 is first index
     # print("a0_cmp, a1_cmp, N_cmp = ", a0_cmp, a1_cmp, N_cmp)
-    compton_matrix = np.zeros((N_Eg, N_cmp))
-    # Read the rest:
-    for i in range(0,N_Eg):
-        fn = "cmp"+str(Eg_sim_array[i])
-        cmp_current = np.genfromtxt(os.path.join(folderpath,"cmp"+str(int(Eg_sim_array[i]))), comments="!")
-        compton_matrix[i,0:len(cmp_current)] = cmp_current
+    # Single precision is ample for the interpolated spectra and halves
+    # the memory traffic of the large arrays; the energy/bin-edge
+    # arithmetic stays in double precision:
+    compton_matrix = np.zeros((N_Eg, N_cmp), dtype=np.float32)
+    # Read the rest. np.loadtxt parses the files much faster than
+    # np.genfromtxt, which carries per-line missing-value machinery we
+    # don't need here. The files are independent, so read them
+    # concurrently to overlap the I/O latency:
+    def read_cmp(fname):
+        return np.loadtxt(fname, comments="!")
+
+    with ThreadPoolExecutor() as executor:
+        for i, cmp_current in enumerate(executor.map(read_cmp, fnames)):
+            compton_matrix[i,0:len(cmp_current)] = cmp_current
 
     # print("compton_matrix =", compton_matrix)
     # compton_matrix = np.tril(compton_matrix)
 
     # Normalize total spectrum to 1, including FE, SE, etc:
+    # Stack the discrete structures column-wise (shape N_Eg x 4) so the
+    # summing and normalization are single vectorized operations:
+    peaks = np.column_stack([FE, SE, DE, c511])
     # Make a vector containing the sums for each step along the Eg_sim dimension:
-    sum_spec = compton_matrix.sum(axis=1) + FE + SE + DE + c511
+    sum_spec = compton_matrix.sum(axis=1) + peaks.sum(axis=1)
 
     # Normalize each part of each spectrum:
     cmp_matrix = div0(compton_matrix,sum_spec.reshape((len(sum_spec),1))) # Still a matrix with Eg_sim along first axis, Ecmp along second
     pcmp = cmp_matrix.sum(axis=1) # Vector of total Compton probability
     # Full energy, single escape, etc:
-    pFE = div0(FE,sum_spec)
-    pSE = div0(SE,sum_spec)
-    pDE = div0(DE,sum_spec)
-    p511 = div0(c511,sum_spec)
+    pFE, pSE, pDE, p511 = div0(peaks, sum_spec.reshape((len(sum_spec),1))).T
 
 
     # == Interpolate the peak structures except Compton, which is handled separately ==
@@ -254,40 +320,70 @@ def interpolate_response(folderpath, Eout_array, fwhm_abs, return_table=False):
     Egmin = Eout_array[0]
     i_Egmin = Emid_to_bin(Egmin, a0_out, a1_out)
 
+    # The Compton spectra inside the loop all need recalibrating from
+    # Ecmp_array to Eout_array. The rebinning weights only depend on the
+    # two calibrations, so compute them once here instead of calling the
+    # rebin function twice per iteration:
+    W_cmp = rebin_weight_matrix(Ecmp_array, Eout_array)
+
+    # Every row of cmp_matrix is rebinned with the same weights, so
+    # apply them to all rows at once as a single matrix product instead
+    # of rebinning row by row inside the loop:
+    cmp_matrix_rebinned = cmp_matrix.dot(W_cmp.T).astype(np.float32)
+
+    # Bracketing simulated spectra for every output energy, found in one
+    # vectorized pass. Long runs of consecutive j's share the same
+    # bracket, and since the rebinned rows are precomputed above, the
+    # per-row work reduces to these index lookups:
+    i_g_sim_high_all = np.searchsorted(Eg_sim_array, Eout_array, side="left")
+    i_g_sim_low_all = np.maximum(
+        np.searchsorted(Eg_sim_array, Eout_array, side="right") - 1, 0)
+
+    # More quantities that only depend on the output energy, hoisted out
+    # of the loop: the maximal energy of each response function (one
+    # vectorized interp1d evaluation instead of a scalar call per row)
+    # and the Compton-edge and back-scattering energies:
+    Egmax_all = Eout_array + fwhm_abs*f_fwhm_rel_perCent_norm(Eout_array)/2.35
+    t_pi = Eout_array/511 * (1 - np.cos(np.pi))
+    Ece_all = np.where(Eout_array > 0.1, Eout_array*t_pi/(1 + t_pi),
+                       Eout_array)
+    Ebsc_all = Eout_array - Ece_all
+    # ... and their bin indices in the output calibration, converted in
+    # one batch per array instead of one scalar Emid_to_bin call each
+    # per row:
+    i_Egmax_all = np.minimum(Emid_to_bin_array(Egmax_all, a0_out, a1_out),
+                             N_out)
+    i_ce_out_all = np.minimum(Emid_to_bin_array(Ece_all, a0_out, a1_out),
+                              i_Egmax_all)
+    i_bsc_out_all = np.maximum(Emid_to_bin_array(Ebsc_all, a0_out, a1_out),
+                               i_Egmin)
+
     # Allocate response matrix array:
-    R = np.zeros((N_out, N_out))
-    # Loop over rows of the response matrix
-    # TODO for speedup: Change this to a cython .pyx, declare the j variable.
-    #                   + run a Cython profiler, probably use memory views and
-    #                   other tweaks to speedup (see rebin.pyx for examples).
-    for j in range(N_out):
+    R = np.zeros((N_out, N_out), dtype=np.float32)
+
+    # Interpolate one row of the response matrix. The rows are
+    # independent (row j only writes R[j, :]), so they are filled in
+    # parallel by the thread pool below:
+    def interpolate_response_row(j):
         E_j = Eout_array[j]
         # Skip if below lower threshold
         if E_j < Egmin:
-            continue
+            return
 
         # Find maximal energy for current response function,
         # Changed to 1*sigma, or whatever this means
         # -> Better if the lowest energies of the simulated spectra are above
         # the gamma energy to be extrapolatedu
-        Egmax = E_j + 1*fwhm_abs*f_fwhm_rel_perCent_norm(E_j)/2.35 #FWHM_rel.max()/2.35
-        i_Egmax = min(Emid_to_bin(Egmax, a0_out, a1_out), N_out)
+        i_Egmax = int(i_Egmax_all[j])
         # print("i_Egmax =", i_Egmax)
 
         # MAMA unfolds with 1/10 of real FWHM for convergence reasons.
         # But let's stick to letting FWHM denote the actual value, and divide by 10 in computations if necessary.
 
-        # Find the closest energies among the available response functions, to interpolate between:
-        i_g_sim_low = 0
-        try:
-            i_g_sim_low = np.where(Eg_sim_array <= E_j)[0][-1]
-        except IndexError:
-            pass
-        i_g_sim_high = N_Eg
-        try:
-            i_g_sim_high = np.where(Eg_sim_array >= E_j)[0][0]
-        except IndexError:
-            pass
+        # The closest energies among the available response functions,
+        # to interpolate between (precomputed outside the loop):
+        i_g_sim_low = int(i_g_sim_low_all[j])
+        i_g_sim_high = int(i_g_sim_high_all[j])
         # When E_out[j] is below lowest Eg_sim_array element? Interpolate between two larger?
         if i_g_sim_low == i_g_sim_high:
             if i_g_sim_low > 0:
@@ -302,11 +398,9 @@ def interpolate_response(folderpath, Eout_array, fwhm_abs, return_table=False):
         # print("Eg_low =", Eg_low, "Eg_high =", Eg_high)
         # print("i_g_sim_low =", i_g_sim_low, "i_g_sim_high =", i_g_sim_high, flush=True)
 
-        cmp_low = cmp_matrix[i_g_sim_low,:]
-        cmp_high = cmp_matrix[i_g_sim_high,:]
-        # These need to be recalibrated from Ecmp_array to Eout_array:
-        cmp_low = rebin_1D(cmp_low, Ecmp_array, Eout_array)
-        cmp_high = rebin_1D(cmp_high, Ecmp_array, Eout_array)
+        # Recalibrated from Ecmp_array to Eout_array:
+        cmp_low = cmp_matrix_rebinned[i_g_sim_low, :]
+        cmp_high = cmp_matrix_rebinned[i_g_sim_high, :]
         # print("Eout_array[{:d}] = {:.1f}".format(j, E_j), "Eg_low =", Eg_sim_array[i_g_sim_low], "Eg_high =", Eg_sim_array[i_g_sim_high], flush=True)
 
         # The interpolation is split into energy regions.
@@ -321,16 +415,12 @@ def interpolate_response(folderpath, Eout_array, fwhm_abs, return_table=False):
         i_high_max = min(Emid_to_bin(E_high_max, a0_out, a1_out), N_out-1)
         # print("E_low_max =", E_low_max, "E_high_max =", E_high_max, flush=True)
 
-        # Find back-scattering Ebsc and compton-edge Ece energy of the current Eout energy:
-        Ece = E_compton(E_j, theta=np.pi)
-        Ebsc = E_j - Ece
-        # if E_j==200:
-        #     print(E_j)
-        #     print("Ece =", Ece)
-        #     print("Ebsc =", Ebsc)
-        # Indices in Eout calibration corresponding to these energies:
-        i_ce_out = min(Emid_to_bin(Ece, a0_out, a1_out), i_Egmax)
-        i_bsc_out = max(Emid_to_bin(Ebsc, a0_out, a1_out), i_Egmin)
+        # Compton-edge energy of the current Eout energy, and the bin
+        # indices of the compton edge and back-scattering energies
+        # (all precomputed):
+        Ece = Ece_all[j]
+        i_ce_out = int(i_ce_out_all[j])
+        i_bsc_out = int(i_bsc_out_all[j])
         # print("i_ce_out =", i_ce_out, ", i_bsc_out =", i_bsc_out, ", i_Egmax =", i_Egmax)
 
 
@@ -338,51 +428,57 @@ def interpolate_response(folderpath, Eout_array, fwhm_abs, return_table=False):
         # ax.axvline(Ece)
 
 
-        # Interpolate one-to-one up to j_bsc_out:
-
-        for i in range(0,i_bsc_out):
-            R[j,i] = cmp_low[i] + (cmp_high[i]-cmp_low[i])*(E_j - Eg_low)/(Eg_high-Eg_low)
-            if R[j,i] < 0:
-                # print("R[{:d},{:d}] = {:.2f}".format(j,i,R[j,i]), flush=True)
-                R[j,i] = 0 # TODO make this faster by indexing at the end
+        # Interpolate one-to-one up to j_bsc_out, clipping any negative
+        # values to zero:
+        t = (E_j - Eg_low)/(Eg_high - Eg_low)
+        R[j, :i_bsc_out] = np.maximum(
+            cmp_low[:i_bsc_out]
+            + (cmp_high[:i_bsc_out] - cmp_low[:i_bsc_out])*t,
+            0)
 
 
 
-        # Then interpolate with the fan method up to j_ce_out:
-        z = 0 # Initialize variable
+        # Then interpolate with the fan method up to j_ce_out.
+        # Each point i only depends on Eout_array[i], so the whole
+        # region is done with array operations:
         i_last = i_bsc_out # Keep track of how far up the fan method goes
         i_low_last = i_bsc_out
         i_high_last = i_bsc_out
 
-        for i in range(i_bsc_out, i_ce_out):
-            E_i = Eout_array[i] # Energy of current point in interpolated spectrum
-            if E_i > 0.1 and E_i < Ece:
-                if np.abs(E_j - E_i) > 0.001:
-                    z = E_i/(E_j/511 * (E_j - E_i))
-                theta = np.arccos(1-z)
-                # print("theta = ", theta, flush=True)
-                if theta > 0 and theta < np.pi:
-                    # Determine interpolation indices in low and high arrays
-                    # by Compton formula
-                    Ecmp_ = E_compton(Eg_low, theta)
-                    i_low_interp = max(Emid_to_bin(Ecmp_, a0_out, a1_out),
-                                       i_bsc_out)
-                    Ecmp_ = E_compton(Eg_high, theta)
-                    i_high_interp = min(Emid_to_bin(Ecmp_, a0_out, a1_out),                i_high_max)
-                    FA = (cmp_high[i_high_interp]*corr(Eg_high, theta)
-                          - cmp_low[i_low_interp]*corr(Eg_low, theta))
-                    FB = cmp_low[i_low_interp]*corr(Eg_low, theta) + FA*(E_j - Eg_low)/(Eg_high - Eg_low)
-                    R[j, i] = FB/corr(E_j, theta)
-                    i_last = i
-                    i_low_last = i_low_interp
-                    i_high_last = i_high_interp
+        i_fan = np.arange(i_bsc_out, i_ce_out)
+        E_i = Eout_array[i_fan] # Energies of the fan-method region
+        mask = (E_i > 0.1) & (E_i < Ece) & (np.abs(E_j - E_i) > 0.001)
+        z = np.zeros(len(i_fan))
+        z[mask] = E_i[mask]/(E_j/511 * (E_j - E_i[mask]))
+        with np.errstate(invalid="ignore"):
+            theta = np.arccos(1-z)  # NaN where z > 2, excluded below
+        fan = mask & (theta > 0) & (theta < np.pi)
+        if np.any(fan):
+            theta = theta[fan]
+            # Determine interpolation indices in low and high arrays
+            # by Compton formula
+            Ecmp_ = E_compton(Eg_low, theta)
+            i_low_interp = np.maximum(Emid_to_bin_array(Ecmp_, a0_out, a1_out),
+                                      i_bsc_out)
+            Ecmp_ = E_compton(Eg_high, theta)
+            i_high_interp = np.minimum(Emid_to_bin_array(Ecmp_, a0_out, a1_out),
+                                       i_high_max)
+            corr_low = corr(Eg_low, theta)
+            corr_high = corr(Eg_high, theta)
+            FA = (cmp_high[i_high_interp]*corr_high
+                  - cmp_low[i_low_interp]*corr_low)
+            FB = cmp_low[i_low_interp]*corr_low + FA*(E_j - Eg_low)/(Eg_high - Eg_low)
+            R[j, i_fan[fan]] = FB/corr(E_j, theta)
+            i_last = i_fan[fan][-1]
+            i_low_last = i_low_interp[-1]
+            i_high_last = i_high_interp[-1]
 
 
         # Interpolate 1-to-1 the last distance up to E+6*sigma
         # print("i_Egmax =", i_Egmax, "Egmax =", Egmax, ", i_last =", i_last, flush=True)
         # Check if this is needed:
         if i_last >= i_Egmax:
-            continue
+            return
         s_low = (i_low_max-i_low_last)/(i_Egmax-i_last)
         s_high = (i_high_max-i_high_last)/(i_Egmax-i_last)
 
@@ -484,12 +580,24 @@ def interpolate_response(folderpath, Eout_array, fwhm_abs, return_table=False):
         R[j, :] += discrete_peaks
 
         # === Finally, normalise the row to unity (probability conservation): ===
-        R[j, :] = div0(R[j, :], np.sum(R[j, :]))
-
+        # One in-place division instead of div0's temporaries; an empty
+        # row (zero sum) is simply left at zero as div0 would:
+        sum_R_j = np.sum(R[j, :])
+        if sum_R_j != 0:
+            np.divide(R[j, :], sum_R_j, out=R[j, :])
+        else:
+            R[j, :] = 0
+
+    # Fill all rows of the response matrix; most of the per-row work is
+    # NumPy operations that release the GIL, so threads overlap well.
+    # list() forces the map so worker exceptions propagate:
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(interpolate_response_row, range(N_out)))
     # END loop over Eout energies Ej
 
-    # Remove any negative elements from response matrix:
-    R[R < 0] = 0
+    # Remove any negative elements from response matrix. np.maximum
+    # clips in place without building a boolean mask:
+    np.maximum(R, 0, out=R)
 
     # for i_plt in [j_test]:
         # ax.plot(Eout_array, R[i_plt,:], label="interpolated, Eout = {:.0f}".format(Eout_array[i_plt]), linestyle="--")
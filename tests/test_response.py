@@ -0,0 +1,15 @@
+import pytest
+import numpy as np
+import ompy as om
+
+
+def test_rebin_weight_matrix():
+    # Rebinning with the overlap matrix should preserve the total number
+    # of counts and agree with the Cython rebin_1D implementation
+    E_in = np.linspace(0, 1000, 101)
+    E_out = np.linspace(0, 1000, 38)
+    counts = np.random.default_rng(42).uniform(size=len(E_in))
+    W = om.rebin_weight_matrix(E_in, E_out)
+    rebinned = W.dot(counts)
+    np.testing.assert_allclose(rebinned.sum(), counts.sum())
+    np.testing.assert_allclose(rebinned, om.rebin_1D(counts, E_in, E_out))